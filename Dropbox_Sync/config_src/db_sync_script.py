@@ -1,15 +1,27 @@
 from typing import Tuple, Any
+import io
 import os
+import sqlite3
+import zipfile
 from pathlib import Path
-from typing import List
+from typing import Set
 import dropbox
 import logging
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 from typing import Any
 from dotenv import load_dotenv
 import random
 from datetime import date
 import config
 
+# Number of concurrent download threads. Kept conservative so we stay
+# under Dropbox's ~100 req/s rate limit instead of triggering 429 storms
+MAX_SYNC_WORKERS = 32
+
 
 # -------------------------------------------------------------------------
 # Handler for checking arguments and creation of options
@@ -29,8 +41,10 @@ def get_args() -> Tuple[str, dict[str, Any]]:
     options["dry-run"] = config.DRY_RUN_DBX
     options["out"] = config.OUTPUT_DBX
     options["flat"] = config.FLAT_DBX
-    options["exclude"] = config.EXCLUDE_DBX
-    options["want"] = config.WANT_DBX
+    # Normalize the extension filters once so the sync loop can do a
+    # single lowercase hash lookup per file
+    options["exclude"] = frozenset(e.lower().lstrip('.') for e in config.EXCLUDE_DBX)
+    options["want"] = frozenset(w.lower().lstrip('.') for w in config.WANT_DBX)
 
     if not os.path.exists(config.DESTINATION_PATH_DBX):
         RuntimeError("ERROR: User Folder Not Found!")
@@ -44,40 +58,54 @@ def get_args() -> Tuple[str, dict[str, Any]]:
     print(config.DESTINATION_PATH_DBX)
     return config.DESTINATION_PATH_DBX, options
 
-def _rec_file_creator(dir_path: Path, root_dir: Path, file_paths: List[str], flat: bool) -> None:
-    """Helper function to recursively walk through directories and collect file paths"""
-    for item in dir_path.iterdir():
-        if item.is_dir(): #if a directory then mark it with 'dir%'
-            rel_path = "dir%/" + str(item.relative_to(root_dir))
-            file_paths.append(rel_path)
-            _rec_file_creator(item, root_dir, file_paths, flat)
-
-        elif item.is_file(): #if a directory then mark it with 'file%'
-            rel_path = "file%/" + (str(item.relative_to(root_dir)) if not flat else str(item.name))
-            file_paths.append(rel_path)
-
-def create_file_list(dir_path: str, flat_download: bool) -> List[str]:
+def create_file_list(dir_path: str, flat_download: bool) -> Tuple[Set[str], Set[str]]:
     """
-    Recursively create a list of all file and folder paths inside dir_path
-    Each folder starts with 'dir%' and each file with 'file%'
+    Create the sets of all folder and all file paths inside dir_path,
+    keyed the way Dropbox reports entries (leading slash, relative to the
+    root) so the sync can test membership without rebuilding keys
+    Built as sets so membership tests against them are constant time
+    Walks with an explicit stack and os.scandir (cached DirEntry type
+    info, no extra stat calls) so huge trees can't hit the recursion
+    limit
     """
-    root_dir = Path(dir_path).resolve()
-    file_paths: List[str] = []
+    root_dir = str(Path(dir_path).resolve())
+    dir_paths: Set[str] = set()
+    file_paths: Set[str] = set()
+
+    stack = [root_dir]
+    while stack:
+        with os.scandir(stack.pop()) as it:
+            for entry in it:
+                if entry.is_dir(follow_symlinks=False):
+                    dir_paths.add("/" + os.path.relpath(entry.path, root_dir))
+                    stack.append(entry.path)
 
-    _rec_file_creator(root_dir, root_dir, file_paths, flat_download)
+                elif entry.is_file():
+                    file_paths.add("/" + (os.path.relpath(entry.path, root_dir)
+                                          if not flat_download else entry.name))
 
-    return file_paths
+    return dir_paths, file_paths
 
 # -------------------------------------------------------------------------
 # Context for syncing
 # -------------------------------------------------------------------------
 class SyncContext:
-    def __init__(self, dbx: dropbox.Dropbox, options: dict[str, Any], dest_root: str, user_dat_paths: [str]) -> None:
+    def __init__(self, dbx: dropbox.Dropbox, options: dict[str, Any], dest_root: str, user_dat_paths: tuple) -> None:
         self.dbx = dbx
         self.options = options
         self.dest_root = dest_root
-        self.user_dat_paths = user_dat_paths
-        self.output_txt = ""
+        # Separate dir/file sets keyed by Dropbox-style paths, frozen so
+        # the per-entry membership tests during the sync are O(1)
+        user_dir_paths, user_file_paths = user_dat_paths
+        self.user_dir_paths = frozenset(user_dir_paths)
+        self.user_file_paths = frozenset(user_file_paths)
+        # List of chunks joined at write-out: += on a growing string is
+        # quadratic, and the log is shared across download threads
+        self.output_log = []
+        self.output_lock = threading.Lock()
+        # Any failure flips this so the run isn't treated as clean (the
+        # listing cursor is only saved after a fully successful sync)
+        self.sync_failed = threading.Event()
 
 # -------------------------------------------------------------------------
 # Setup logging and logging colors
@@ -108,25 +136,56 @@ def load_dbx_api() -> dropbox.Dropbox:
     token = os.getenv("DBX_TOKEN")
     if not token:
         raise RuntimeError("Dropbox token not found. Set DBX_TOKEN environment variable.")
-    return dropbox.Dropbox(token)
+
+    # One warm HTTPS session shared by every download thread: a pool big
+    # enough for all workers skips the per-request TLS handshake, and
+    # transient failures retry with backoff (honoring Retry-After on 429s)
+    # allowed_methods=None retries every verb: Dropbox RPCs are all POSTs,
+    # which urllib3 refuses to retry by default
+    session = dropbox.create_session(max_connections=MAX_SYNC_WORKERS)
+    session.mount("https://", HTTPAdapter(
+        pool_connections=MAX_SYNC_WORKERS,
+        pool_maxsize=MAX_SYNC_WORKERS,
+        max_retries=Retry(total=5, backoff_factor=0.5,
+                          status_forcelist=(429, 500, 502, 503, 504),
+                          allowed_methods=None,
+                          respect_retry_after_header=True),
+    ))
+    return dropbox.Dropbox(token, session=session, timeout=30)
 
 # -------------------------------------------------------------------------
 # File Ops
 # -------------------------------------------------------------------------
+# Attempts for a persistently rate-limited call before giving up, so a
+# 429 storm can't pin a worker thread forever
+MAX_RATE_LIMIT_RETRIES = 5
+
+def call_with_backoff(fn, *args):
+    """Call a Dropbox RPC, sleeping out the backoff Dropbox asks for on 429s"""
+    for _ in range(MAX_RATE_LIMIT_RETRIES):
+        try:
+            return fn(*args)
+        except dropbox.exceptions.RateLimitError as err:
+            time.sleep(err.backoff if err.backoff else 1)
+    # Out of retries: let the last attempt's error reach the caller
+    return fn(*args)
+
 def create_folder(ctx: SyncContext, folder_name: str, src_path: str, depth: int) -> None:
     """Create a folder locally"""
     try:
         os.makedirs(os.path.join(ctx.dest_root, src_path.strip("/"), folder_name), exist_ok=True)
         log_blue(f"Created folder: {folder_name} in {ctx.dest_root}")
-        ctx.output_txt += "+d:" + '\t'*depth + f"{folder_name}\n"
+        with ctx.output_lock:
+            ctx.output_log.append("+d:" + '\t'*depth + f"{folder_name}\n")
     except Exception as err:
         logging.error(f"Failed to create folder {folder_name}: {err}")
 
 def download_file(ctx: SyncContext, src_path: str, depth: int) -> None:
     """Download a file from Dropbox to local directory"""
     try:
-        # Load in the file data
-        metadata, res = ctx.dbx.files_download(src_path)
+        # Load in the file data (honoring the backoff Dropbox asks for if
+        # we get rate limited)
+        metadata, res = call_with_backoff(ctx.dbx.files_download, src_path)
         # Create the local path of downloaded file
         local_path = os.path.join(ctx.dest_root, src_path.strip("/")) if not ctx.options["flat"] \
             else f"{ctx.dest_root}/{metadata.name}"
@@ -137,51 +196,196 @@ def download_file(ctx: SyncContext, src_path: str, depth: int) -> None:
                 f.write(res.content)
 
         log_green(f"Downloaded {metadata.name} to {local_path}")
-        ctx.output_txt += "+f:" + '\t'*depth + f"{metadata.name}\n"
+        with ctx.output_lock:
+            ctx.output_log.append("+f:" + '\t'*depth + f"{metadata.name}\n")
 
-    except dropbox.exceptions.ApiError as err:
+    except (dropbox.exceptions.ApiError, dropbox.exceptions.RateLimitError) as err:
         logging.error(f"Dropbox API error downloading {src_path}: {err}")
+        ctx.sync_failed.set()
+
+def download_folder_files(ctx: SyncContext, src_path: str, depth: int) -> None:
+    """Download every file in a Dropbox subtree one at a time"""
+    try:
+        result = call_with_backoff(
+            lambda p: ctx.dbx.files_list_folder(p, recursive=True), src_path)
+        while True:
+            for entry in result.entries:
+                if isinstance(entry, dropbox.files.FileMetadata):
+                    download_file(ctx, entry.path_display, entry.path_display.count("/") - 1)
+            if not result.has_more:
+                break
+            result = call_with_backoff(ctx.dbx.files_list_folder_continue, result.cursor)
+    except (dropbox.exceptions.ApiError, dropbox.exceptions.RateLimitError) as err:
+        logging.error(f"Error listing folder {src_path}: {err}")
+        ctx.sync_failed.set()
+
+def download_folder_zip(ctx: SyncContext, src_path: str, depth: int) -> None:
+    """Download a whole Dropbox folder as one zip and unpack it locally"""
+    try:
+        # Fetch the zipped subtree in a single round-trip (honoring the
+        # backoff Dropbox asks for if we get rate limited)
+        metadata, res = call_with_backoff(ctx.dbx.files_download_zip, src_path)
+
+        if not ctx.options["dry-run"]:  # (skip if doing a dry run)
+            # The zip contains the folder itself, so unpack into its parent
+            local_parent = os.path.join(ctx.dest_root, os.path.dirname(src_path).strip("/"))
+            os.makedirs(local_parent, exist_ok=True)
+            with zipfile.ZipFile(io.BytesIO(res.content)) as zf:
+                zf.extractall(local_parent)
+
+        log_green(f"Downloaded folder {src_path} as zip to {ctx.dest_root}")
+        with ctx.output_lock:
+            ctx.output_log.append("+z:" + '\t'*depth + f"{os.path.basename(src_path)}\n")
+
+    except (dropbox.exceptions.ApiError, dropbox.exceptions.RateLimitError) as err:
+        # Dropbox rejects the zip endpoint for folders over ~20 GB or
+        # 10,000 files. The listing walk already skipped this subtree, so
+        # fall back to fetching it per file instead of silently losing it,
+        # and mark the run dirty so the cursor isn't advanced past it
+        logging.error(f"Dropbox API error downloading folder {src_path}: {err}")
+        ctx.sync_failed.set()
+        download_folder_files(ctx, src_path, depth)
+
+# -------------------------------------------------------------------------
+# Cursor cache for incremental syncs
+# -------------------------------------------------------------------------
+CURSOR_CACHE_PATH = os.path.expanduser("~/.dbx_sync_cache.sqlite")
+
+def _cursor_db() -> sqlite3.Connection:
+    """Open (creating if needed) the on-disk cursor cache"""
+    conn = sqlite3.connect(CURSOR_CACHE_PATH)
+    conn.execute("CREATE TABLE IF NOT EXISTS cursors ("
+                 "root TEXT PRIMARY KEY, cursor TEXT, updated TIMESTAMP)")
+    return conn
+
+def load_cached_cursor(root: str) -> str:
+    """Return the listing cursor saved for this sync root (None on a first run)"""
+    try:
+        with _cursor_db() as conn:
+            row = conn.execute("SELECT cursor FROM cursors WHERE root = ?", (root,)).fetchone()
+        return row[0] if row else None
+    except sqlite3.Error as err:
+        logging.error(f"Failed to read cursor cache: {err}")
+        return None
+
+def save_cached_cursor(root: str, cursor: str) -> None:
+    """Remember the listing cursor so the next run only fetches deltas"""
+    try:
+        with _cursor_db() as conn:
+            conn.execute("INSERT OR REPLACE INTO cursors VALUES (?, ?, datetime('now'))",
+                         (root, cursor))
+    except sqlite3.Error as err:
+        logging.error(f"Failed to write cursor cache: {err}")
 
 # -------------------------------------------------------------------------
 # Recursive Sync
 # -------------------------------------------------------------------------
-def recursive_sync(ctx: SyncContext, src_path: str, depth: int) -> None:
-    """Recursively sync Dropbox folder with local directory"""
+def recursive_sync(ctx: SyncContext, src_path: str,
+                   executor: ThreadPoolExecutor, futures: list) -> str:
+    """
+    Sync a Dropbox subtree with the local directory
+    Lists the whole subtree with one recursive files_list_folder call
+    (paged through files_list_folder_continue) instead of one listing
+    round-trip per directory, submitting downloads as each page arrives
+    Returns the cursor where the listing ended (None if it failed)
+    """
+    # Hoist the per-entry lookups to locals: dict and attribute resolution
+    # is a real cost inside a loop that runs once per remote entry
+    excl = ctx.options["exclude"]
+    want = ctx.options["want"]
+    rnd = ctx.options["random"]
+    flat = ctx.options["flat"]
+    dir_paths = ctx.user_dir_paths
+    file_paths = ctx.user_file_paths
+    rand = random.random
+    submit = executor.submit
+    splitext = os.path.splitext
+    FileMeta = dropbox.files.FileMetadata
+    FolderMeta = dropbox.files.FolderMetadata
+
+    has_excl = bool(excl)
+    has_want = bool(want)
+    # Only an unfiltered run considers every remote file, so only then is
+    # a delta listing safe: a cursor saved on a sampled or filtered run
+    # would hide the files it skipped from every later sync
+    unfiltered = not has_excl and not has_want and rnd >= 1.0
+    # When every file passes the filters anyway, a missing folder can be
+    # fetched as one zip instead of hundreds of per-file round-trips
+    take_all = unfiltered and not flat
+    zipped_roots = []
+
     try:
-        result = ctx.dbx.files_list_folder(src_path)
-        for entry in result.entries:
-            # Entry is a FILE
-            if isinstance(entry, dropbox.files.FileMetadata):
-                # Get the path of the file
-                dbx_file_path = f"{entry.path_display}" if not ctx.options["flat"] else f"/{entry.name}"
-                # Check if the file exists AND if it passes the probability
-                if (f"file%{dbx_file_path}" not in ctx.user_dat_paths and
-                        random.random() <= ctx.options["random"] and
-                        (entry.name.split('.')[-1] not in ctx.options["exclude"] if len(ctx.options["exclude"]) > 0 else True) and
-                        (entry.name.split('.')[-1] in ctx.options["want"] if len(ctx.options["want"]) > 0 else True)
-                ):
-                    # Download the missing file
-                    download_file(ctx, entry.path_display, depth)
-
-            # Entry is a FOLDER
-            elif isinstance(entry, dropbox.files.FolderMetadata):
-                # Get the path to the dir
-                dbx_dir_path = f"{entry.path_display}"
-                # Check if the dir exists (don't make new one if flat output)
-                if f"dir%{dbx_dir_path}" not in ctx.user_dat_paths and not ctx.options["flat"]:
-                    # Create the missing dir
-                    create_folder(ctx, entry.name, src_path, depth)
-
-                # Recurse inside the directory
-                recursive_sync(ctx, entry.path_display, depth + 1)
-
-    except dropbox.exceptions.ApiError as err:
+        # A cursor from a previous run means Dropbox can send just the
+        # entries that changed since then, so a no-op sync is one RPC
+        cursor = load_cached_cursor(ctx.dest_root) if unfiltered else None
+        if cursor:
+            try:
+                result = call_with_backoff(ctx.dbx.files_list_folder_continue, cursor)
+                log_blue("Resuming from cached cursor, syncing deltas only")
+            except dropbox.exceptions.ApiError:
+                # Cursor expired or was invalidated: fall back to a full listing
+                cursor = None
+        if not cursor:
+            result = call_with_backoff(
+                lambda p: ctx.dbx.files_list_folder(p, recursive=True), src_path)
+        while True:
+            for entry in result.entries:
+                # Skip anything already covered by a zipped folder download
+                if any(entry.path_display.startswith(f"{root}/") for root in zipped_roots):
+                    continue
+
+                # Depth below the root, used to indent the output log
+                depth = entry.path_display.count("/") - 1
+
+                # Entry is a FILE
+                if isinstance(entry, FileMeta):
+                    # Filter on extension: one hash lookup per file
+                    ext = splitext(entry.name)[1][1:].lower()
+                    if ((has_excl and ext in excl) or
+                            (has_want and ext not in want)):
+                        continue
+
+                    # Get the path of the file
+                    dbx_file_path = entry.path_display if not flat else f"/{entry.name}"
+                    # Check if the file exists AND if it passes the probability
+                    if dbx_file_path not in file_paths and rand() <= rnd:
+                        # Download the missing file
+                        futures.append(submit(download_file, ctx, entry.path_display, depth))
+
+                # Entry is a FOLDER
+                elif isinstance(entry, FolderMeta):
+                    # Get the path to the dir
+                    dbx_dir_path = entry.path_display
+                    # A folder missing locally on an unfiltered sync means
+                    # its whole subtree is missing: grab it as one zip
+                    if take_all and dbx_dir_path not in dir_paths:
+                        futures.append(submit(download_folder_zip, ctx, dbx_dir_path, depth))
+                        zipped_roots.append(dbx_dir_path)
+                    # Check if the dir exists (don't make new one if flat output)
+                    elif dbx_dir_path not in dir_paths and not flat:
+                        # Create the missing dir
+                        create_folder(ctx, entry.name, os.path.dirname(dbx_dir_path), depth)
+
+            # Fetch the next page of entries (downloads from the previous
+            # pages keep running on the executor in the meantime)
+            if not result.has_more:
+                break
+            result = call_with_backoff(ctx.dbx.files_list_folder_continue, result.cursor)
+
+        # Hand back where this run ended; the caller saves it once every
+        # submitted download has actually landed (filtered runs never
+        # save one, see above)
+        return result.cursor if unfiltered else None
+
+    except (dropbox.exceptions.ApiError, dropbox.exceptions.RateLimitError) as err:
         logging.error(f"Error listing folder {src_path}: {err}")
+        ctx.sync_failed.set()
+        return None
 
 # -------------------------------------------------------------------------
 # Main entry
 # -------------------------------------------------------------------------
-def update_local_dir(dbx: dropbox.Dropbox, options: dict[str, any], user_dir_path: str, user_dat_paths: [str]) -> None:
+def update_local_dir(dbx: dropbox.Dropbox, options: dict[str, any], user_dir_path: str, user_dat_paths: tuple) -> None:
     """Update local directory with missing files from Dropbox"""
     # Create sync context
     ctx = SyncContext(dbx, options, user_dir_path, user_dat_paths)
@@ -192,15 +396,29 @@ def update_local_dir(dbx: dropbox.Dropbox, options: dict[str, any], user_dir_pat
 
     logging.info("Starting Dropbox sync...")
 
-    # Begin recursive walk through the dropbox
-    recursive_sync(ctx, "", 0)
+    # Begin recursive walk through the dropbox, fanning downloads and
+    # subfolder listings out over a bounded thread pool
+    with ThreadPoolExecutor(max_workers=MAX_SYNC_WORKERS) as executor:
+        futures = []
+        cursor = recursive_sync(ctx, "", executor, futures)
+
+        # Wait for all the submitted downloads to finish
+        while futures:
+            futures.pop().result()
+
+    # Only remember where this run ended once every download has landed:
+    # a cursor saved past a failed subtree would hide it from later runs
+    # (skipped on dry runs so the next real sync still sees everything)
+    if cursor and not ctx.options["dry-run"] and not ctx.sync_failed.is_set():
+        save_cached_cursor(ctx.dest_root, cursor)
 
     logging.info("Sync completed successfully.")
 
     if ctx.options["out"]:
-        with open(f"{user_dir_path}/dbx_{date.today()}.out", "w") as f:
-            f.write(ctx.output_txt)
-        print(f"Output written to dbx_{date.today()}.out")
+        today = date.today()
+        with open(f"{user_dir_path}/dbx_{today}.out", "w") as f:
+            f.writelines(ctx.output_log)
+        print(f"Output written to dbx_{today}.out")
 
 if __name__ == "__main__":
     # Take in args
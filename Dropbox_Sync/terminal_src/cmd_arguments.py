@@ -88,7 +88,9 @@ def get_args() -> Tuple[str, dict[str, Any]]:
     options["dry-run"] = args.dry_run
     options["out"] = args.out
     options["flat"] = args.flat
-    options["exclude"] = args.exclude
-    options["want"] = args.want
+    # Normalize the extension filters once so the sync loop can do a
+    # single lowercase hash lookup per file
+    options["exclude"] = frozenset(e.lower().lstrip('.') for e in args.exclude)
+    options["want"] = frozenset(w.lower().lstrip('.') for w in args.want)
 
     return args.path, options
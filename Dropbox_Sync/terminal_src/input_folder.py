@@ -1,27 +1,31 @@
 import os
 from pathlib import Path
-from typing import List
+from typing import Set, Tuple
 
-def _rec_file_creator(dir_path: Path, root_dir: Path, file_paths: List[str], flat: bool) -> None:
-    """Helper function to recursively walk through directories and collect file paths"""
-    for item in dir_path.iterdir():
-        if item.is_dir(): #if a directory then mark it with 'dir%'
-            rel_path = "dir%/" + str(item.relative_to(root_dir))
-            file_paths.append(rel_path)
-            _rec_file_creator(item, root_dir, file_paths, flat)
-
-        elif item.is_file(): #if a directory then mark it with 'file%'
-            rel_path = "file%/" + (str(item.relative_to(root_dir)) if not flat else str(item.name))
-            file_paths.append(rel_path)
-
-def create_file_list(dir_path: str, flat_download: bool) -> List[str]:
+def create_file_list(dir_path: str, flat_download: bool) -> Tuple[Set[str], Set[str]]:
     """
-    Recursively create a list of all file and folder paths inside dir_path
-    Each folder starts with 'dir%' and each file with 'file%'
+    Create the sets of all folder and all file paths inside dir_path,
+    keyed the way Dropbox reports entries (leading slash, relative to the
+    root) so the sync can test membership without rebuilding keys
+    Built as sets so membership tests against them are constant time
+    Walks with an explicit stack and os.scandir (cached DirEntry type
+    info, no extra stat calls) so huge trees can't hit the recursion
+    limit
     """
-    root_dir = Path(dir_path).resolve()
-    file_paths: List[str] = []
+    root_dir = str(Path(dir_path).resolve())
+    dir_paths: Set[str] = set()
+    file_paths: Set[str] = set()
+
+    stack = [root_dir]
+    while stack:
+        with os.scandir(stack.pop()) as it:
+            for entry in it:
+                if entry.is_dir(follow_symlinks=False):
+                    dir_paths.add("/" + os.path.relpath(entry.path, root_dir))
+                    stack.append(entry.path)
 
-    _rec_file_creator(root_dir, root_dir, file_paths, flat_download)
+                elif entry.is_file():
+                    file_paths.add("/" + (os.path.relpath(entry.path, root_dir)
+                                          if not flat_download else entry.name))
 
-    return file_paths
+    return dir_paths, file_paths
@@ -7,8 +7,10 @@ import matplotlib.pyplot as plt
 from astropy.io import fits
 import argparse
 import datetime
+from concurrent.futures import ProcessPoolExecutor
+from functools import partial
 
-def get_args()->Tuple[str, str, bool, bool, bool]:
+def get_args()->Tuple[str, str, bool, bool, bool, bool]:
     """
     Parse command-line arguments for converter
     :return str: The source filename and destination folder
@@ -44,6 +46,11 @@ def get_args()->Tuple[str, str, bool, bool, bool]:
         action="store_true",
         help="If set true will output the spectrogram plots as .csv files"
     )
+    parser.add_argument(
+        "-q", "--quantize",
+        action="store_true",
+        help="If set true will store FITS data as scaled uint8 (half the size) when the dynamic range allows"
+    )
     args = parser.parse_args()
 
     # Check source file
@@ -61,7 +68,7 @@ def get_args()->Tuple[str, str, bool, bool, bool]:
     elif not os.path.isdir(args.destination):
         raise RuntimeError(f"ERROR: Destination path is not a directory: {args.destination}")
 
-    return args.source, args.destination, args.output, args.numpy, args.csv
+    return args.source, args.destination, args.output, args.numpy, args.csv, args.quantize
 
 def get_sps_in_directory(directory_path: str)->list:
     """
@@ -76,108 +83,125 @@ def get_sps_in_directory(directory_path: str)->list:
                 sps_files.append(os.path.join(root, f))
     return sps_files
 
-def extract_bytes(mapped_file: mmap.mmap, n_bytes: int, start_offset: int=0)->bytes:
+def extract_bytes(mapped_file: mmap.mmap, n_bytes: int, start_offset: int=0)->memoryview:
     """
     Given a byte mapped file, will extract and return the n_bytes starting
-    from the offset as a string.
+    from the offset as a zero-copy memoryview (slicing the mmap directly
+    would allocate a fresh bytes object per call).
     :param mapped_file: The memory mapped file of the sps file
     :param n_bytes: The number of bytes to extract
     :param start_offset: The offset to start extracting from
-    :return: The extracted bytes
+    :return: A memoryview of the extracted bytes
     """
     # Check that the end point doesn't go out of bounds
-    if start_offset + n_bytes >= mapped_file.size():
-        print(f"Out-of-bounds by {start_offset+n_bytes - mapped_file.size()}")
-        return bytes(0) #consider exiting program
-
-    # Extract and interpret as ascii
-    return mapped_file[start_offset: start_offset + n_bytes]
-
-def interpret_bytes(byte_data: bytes, data_type: str)->Any:
+    if start_offset + n_bytes >= len(mapped_file):
+        print(f"Out-of-bounds by {start_offset+n_bytes - len(mapped_file)}")
+        return memoryview(bytes(0)) #consider exiting program
+
+    # Extract without copying
+    return memoryview(mapped_file)[start_offset: start_offset + n_bytes]
+
+# Precompiled Structs: unpack_from reads straight out of a memoryview
+# with no format-string parse and no intermediate bytes object
+# '>' is big endian and '<' is little endian
+_REAL64 = struct.Struct("<d") #d for double
+_INT16  = struct.Struct("<h") #h for half signed
+_INT32  = struct.Struct("<i") #i for int signed
+_UINT16 = struct.Struct(">H") #H for half unsigned
+
+# Dispatch table bound once at import: each type tag maps straight to
+# its parser, so interpreting a value is one dict lookup instead of
+# re-running a string-compare chain per call
+PARSERS = {
+    "String": lambda b: bytes(b).decode('ascii'),
+    "Real64": lambda b: _REAL64.unpack_from(b)[0],
+    "Int16":  lambda b: _INT16.unpack_from(b)[0],
+    "Int32":  lambda b: _INT32.unpack_from(b)[0],
+    "UInt16": lambda b: _UINT16.unpack_from(b)[0],
+}
+
+def interpret_bytes(byte_data, data_type: str)->Any:
     """
-    Given bytes and the data type, interpret the bytes as the given data type.
+    Given bytes (or a memoryview) and the data type, interpret the bytes
+    as the given data type.
     :param byte_data: bytes to interpret
     :param data_type: data type to interpret
     :return data_type: The bytes in the interpreted data type
     """
-    if data_type == "String":
-        return byte_data.decode('ascii')
-    # '>' is big endian and '<' is little endian
-    elif data_type == "Real64":
-        return struct.unpack("<d", byte_data)[0] #d for double
-    elif data_type == "Int16":
-        return struct.unpack("<h", byte_data)[0] #h for half signed
-    elif data_type == "Int32":
-        return struct.unpack("<i", byte_data)[0] #i for int signed
-    elif data_type == "UInt16":
-        return struct.unpack(">H", byte_data)[0] #H for half unsigned
-    else: #should never be reached
+    parser = PARSERS.get(data_type)
+    if parser is None: #should never be reached
         return byte_data
+    return parser(byte_data)
+
+# The 156-byte header record (field positions per the SPS specs, 1-indexed)
+HDR_DTYPE = np.dtype([
+    # Name          Type     Position
+    ("Version",    "S10"),  # 1
+    ("Start",      "<f8"),  # 11
+    ("End",        "<f8"),  # 19
+    ("Latitude",   "<f8"),  # 27
+    ("Longitude",  "<f8"),  # 35
+    ("ChartMax",   "<f8"),  # 43
+    ("ChartMin",   "<f8"),  # 51
+    ("TimeZone",   "<i2"),  # 59
+    ("Source",     "S10"),  # 61
+    ("Author",     "S20"),  # 71
+    ("Name",       "S20"),  # 91
+    ("Location",   "S40"),  # 111
+    ("Channels",   "<i2"),  # 151
+    ("NoteLength", "<i4"),  # 153
+])
 
 def extract_sps_header(mapped_file: mmap.mmap)->dict:
     """
     Given the sps file will extract and store the data of the header section.
-    Will also have the number of bytes after position 152 where the data begins
+    Will also have the number of bytes after position 152 where the data begins.
+    Parses the whole 156-byte record in a single numpy read instead of
+    unpacking each field separately.
     :param mapped_file: Memory mapped sps file
     :return: a dictionary with the header values of the sps file
     """
-    fields = [
-        # Position  Name        Type       Bytes
-        (1,        "Version",   "String",  10),
-        (11,       "Start",     "Real64",   8),
-        (19,       "End",       "Real64",   8),
-        (27,       "Latitude",  "Real64",   8),
-        (35,       "Longitude", "Real64",   8),
-        (43,       "ChartMax",  "Real64",   8),
-        (51,       "ChartMin",  "Real64",   8),
-        (59,       "TimeZone",  "Int16",    2),
-        (61,       "Source",    "String",  10),
-        (71,       "Author",    "String",  20),
-        (91,       "Name",      "String",  20),
-        (111,      "Location",  "String",  40),
-        (151,      "Channels",  "Int16",    2),
-        (153,      "NoteLength","Int32",    4),
-    ]
-    sps_header = {}
-
-    for pos, name, data_type, size in fields:
-        #1. Extract the raw value
-        value = extract_bytes(mapped_file, size, pos-1) #Is 1-index in the specs
-
-        #2. Based on the type reinterpret it
-        value = interpret_bytes(value, data_type)
-
-        #3. Store the value
-        sps_header[name] = value
-
-    return sps_header
-
-def read_sps_data(mapped_file: mmap.mmap, start_byte: int)->list:
+    record = np.frombuffer(mapped_file, dtype=HDR_DTYPE, count=1)[0]
+
+    # Decode the string fields, everything else becomes a plain Python scalar
+    return {
+        name: record[name].decode('ascii') if HDR_DTYPE[name].kind == 'S'
+              else record[name].item()
+        for name in HDR_DTYPE.names
+    }
+
+END_DELIMITER = 0xFEFE # End-of-Sweep marker, big endian
+
+def read_sps_data(mapped_file: mmap.mmap, start_byte: int)->np.ndarray:
     """
     Reads the sweep data from the sps file.
+    Parses the whole data section in one numpy pass instead of looping
+    over the mmap two bytes at a time.
     :param mapped_file: The memory mapped sps file
     :param start_byte: The byte to start reading the sps data from
-    :return: A 2d list of each sweep, where the ith row is the data of the ith sweep
+    :return: A 2d array of each sweep, where the ith row is the data of the ith sweep
     """
-    end_delimiter = interpret_bytes(b'\xFE\xFE', "UInt16")
-
-    sweep_count = 0
-    current_byte = start_byte
-    sweep_data = []
-    current_sweep = []
-    try:
-        while current_byte < mapped_file.size() - 1: # Exclude end of file delimiter
-            byte_val = interpret_bytes(extract_bytes(mapped_file, 2, current_byte), "UInt16")
-            if byte_val == end_delimiter: # Reached the End-of-Sweep delimiter
-                sweep_data.append(current_sweep)
-                current_sweep = []
-                sweep_count += 1
-            else:
-                current_sweep.append(byte_val)
-            current_byte += 2
-    except Exception as e:
-        print(f"An error occurred: {e}, please tell whoever wrote this to lock in")
-        return []
+    # Interpret the whole data section as big endian uint16 in one shot
+    # (the // 2 drops a lone trailing odd byte, same as the old per-byte loop)
+    n_samples = (mapped_file.size() - start_byte) // 2
+    raw = np.frombuffer(mapped_file, dtype='>u2', count=n_samples, offset=start_byte)
+
+    # Find every End-of-Sweep delimiter
+    idx = np.flatnonzero(raw == END_DELIMITER)
+    if idx.size == 0:
+        return np.empty((0, 0), dtype=np.uint16)
+
+    # Drop any trailing partial sweep after the last delimiter
+    raw = raw[:idx[-1] + 1]
+
+    channels = idx[0]
+    if np.all(np.diff(idx) == channels + 1):
+        # Uniform sweeps (the common case): reshape so each row is one
+        # sweep plus its delimiter, then strip the delimiter column
+        sweep_data = raw.reshape(-1, channels + 1)[:, :-1]
+    else:
+        # Ragged sweeps: split after each delimiter and strip it
+        sweep_data = [s[:-1] for s in np.split(raw, idx[:-1] + 1)]
 
     return sweep_data
 
@@ -192,7 +216,7 @@ def sps_to_datetime(value):
     return (epoch + delta).isoformat()
 
 def convert_sps_fits(sweep_data: np.ndarray, sps_header: dict, file_name: str, destination_dir: str,
-                     as_numpy: bool, as_csv: bool)->str:
+                     as_numpy: bool, as_csv: bool, quantize: bool=False)->str:
     """
     Taking the sweep data from the sps file and converting it into a fits file.
     :param sweep_data: The numpy array of the sweep data
@@ -200,10 +224,31 @@ def convert_sps_fits(sweep_data: np.ndarray, sps_header: dict, file_name: str, d
     :param file_name: The name of the input file
     :param destination_dir: The destination directory
     :param as_numpy: Whether to write the sweep data as a numpy array
+    :param quantize: Whether to store the FITS data as scaled uint8
     :return: The name of the new FITS file
     """
-    # Create individual hdu
-    hdu = fits.PrimaryHDU(data=sweep_data)
+    # Optionally quantize to uint8 with a BSCALE/BZERO linear mapping,
+    # which FITS readers apply transparently. Only for the FITS output
+    # (csv/npy can't carry the scale) and only when the dynamic range is
+    # narrow enough to represent faithfully
+    bscale = bzero = None
+    if quantize:
+        mn, mx = int(sweep_data.min()), int(sweep_data.max())
+        if mx - mn <= 4096:
+            bscale = (mx - mn) / 255.0 if mx > mn else 1.0
+            bzero = float(mn)
+            fits_data = np.round((sweep_data - mn) / bscale).astype(np.uint8)
+    if bscale is None:
+        # FITS stores integers big endian, so hand astropy a contiguous
+        # big endian copy up front and its writer can dump it straight out
+        fits_data = np.ascontiguousarray(sweep_data, dtype='>u2')
+
+    # Create individual hdu (uint=True keeps uint16 as BZERO-shifted
+    # int16 per the standard, without a data rescale scan)
+    hdu = fits.PrimaryHDU(data=fits_data, do_not_scale_image_data=True, uint=True)
+    if bscale is not None:
+        hdu.header['BSCALE'] = bscale
+        hdu.header['BZERO']  = bzero
     hdu.header['OBJECT']    = 'RSS Spectrogram'
     hdu.header['COMMENT']   = 'Created from SPS sweep data'
     hdu.header['BUNIT']     = 'Intensity'
@@ -213,19 +258,26 @@ def convert_sps_fits(sweep_data: np.ndarray, sps_header: dict, file_name: str, d
     hdu.header['DATE-OBS']  = sps_to_datetime(sps_header['Start'])
     hdu.header['DATE-END']  = sps_to_datetime(sps_header['End'])
 
-    # Create HDU list
-    hdu_list = fits.HDUList([hdu])
-
     # Create the Fits file
     file_path = f'{destination_dir}/{file_name[:-4]}'
     if as_csv: # CSV
-        a = np.asarray(sweep_data)
-        np.savetxt(f"{file_path}.csv", a, delimiter=",")
+        a = np.ascontiguousarray(sweep_data, dtype=np.uint16) #pyarrow wants native byte order
+        try:
+            # pyarrow's C writer is an order of magnitude faster than
+            # np.savetxt's per-cell Python formatting (imported lazily so
+            # FITS-only runs don't pay for it)
+            import pyarrow as pa
+            from pyarrow import csv as pa_csv
+            table = pa.table({str(i): a[:, i] for i in range(a.shape[1])})
+            pa_csv.write_csv(table, f"{file_path}.csv",
+                             pa_csv.WriteOptions(include_header=False))
+        except ImportError:
+            np.savetxt(f"{file_path}.csv", a, delimiter=",", fmt='%d')
     if as_numpy: # Numpy
         np.save(f'{file_path}.npy', sweep_data)
     if not as_csv and not as_numpy: # Fits
         file_path = f'{file_path}.fits'
-        hdu_list.writeto(file_path, overwrite=True)
+        hdu.writeto(file_path, overwrite=True, checksum=False)
 
     return file_path
 
@@ -267,17 +319,34 @@ def plot_sps_spectrogram(sweep_array: np.ndarray)->None:
     plt.colorbar(label='Intensity')
     plt.show()
 
-def main():
-    src_dir, dest_dir, show, as_numpy, as_csv = get_args()
-    sps_files = get_sps_in_directory(src_dir)
-
-    print(f"Converting {len(sps_files)} sps files...")
-
-    count = 0
-    for file_path in sps_files:
+def _convert_one(file_path: str, dest_dir: str, as_numpy: bool, as_csv: bool, quantize: bool=False,
+                 show: bool=False)->str:
+    """
+    Converts a single sps file (the body of the old main loop).
+    Each file is independent so this can run in a worker process,
+    except when show is set (matplotlib must stay in the main process).
+    :param file_path: Path to the sps file to convert
+    :param dest_dir: The destination directory
+    :param as_numpy: Whether to write the sweep data as a numpy array
+    :param as_csv: Whether to write the sweep data as a csv file
+    :param quantize: Whether to store the FITS data as scaled uint8
+    :param show: Whether to display the spectrogram plots
+    :return: The path of the converted file, or None if data reading went wrong
+    """
+    # One broken file shouldn't kill a whole directory conversion, and
+    # keeping the try at the per-file boundary leaves the parse functions
+    # free of big exception frames
+    try:
         with open(file_path, "rb") as file:
             #1. Memory Map File
+            # Tell the kernel we'll stream the file front to back so it
+            # reads ahead aggressively instead of faulting page by page
+            if hasattr(os, "posix_fadvise"):
+                os.posix_fadvise(file.fileno(), 0, 0, os.POSIX_FADV_SEQUENTIAL)
+                os.posix_fadvise(file.fileno(), 0, 0, os.POSIX_FADV_WILLNEED)
             mf = mmap.mmap(file.fileno(), 0, prot=mmap.PROT_READ)
+            if hasattr(mf, "madvise"):
+                mf.madvise(mmap.MADV_SEQUENTIAL)
 
             #2. Extract the SPS header
             sps_header = extract_sps_header(mf)
@@ -288,21 +357,52 @@ def main():
             #4. Read in the data
             sweep_data = read_sps_data(mf, data_head)
             if len(sweep_data) == 0: #If data reading went wrong skip this file
-                continue
+                return None
 
-            #5. Convert to numpy array
-            sweep_array = np.array(sweep_data, dtype=np.uint16)
+            #5. Convert to numpy array. read_sps_data already produced a
+            #   uint16 ndarray for uniform sweeps, so this is free; only a
+            #   ragged list of per-sweep arrays still pays for a stack
+            sweep_array = np.asarray(sweep_data)
 
             #6. Convert to a fits file! (or numpy if specified)
-            fits_path = convert_sps_fits(sweep_array, sps_header, os.path.basename(file_path), dest_dir, as_numpy, as_csv)
+            fits_path = convert_sps_fits(sweep_array, sps_header, os.path.basename(file_path), dest_dir, as_numpy, as_csv, quantize)
 
             #7. Display the results (optional)
-            count += 1
-            print(f"\tConverted {count}/{len(sps_files)} sps files...")
             if show and not as_numpy and not as_csv:
                 plot_sps_spectrogram(sweep_array)
                 plot_fits_spectrogram(fits_path)
 
+            return fits_path
+    except Exception as e:
+        print(f"Failed to convert {file_path}: {e}")
+        return None
+
+def main():
+    src_dir, dest_dir, show, as_numpy, as_csv, quantize = get_args()
+    sps_files = get_sps_in_directory(src_dir)
+
+    print(f"Converting {len(sps_files)} sps files...")
+
+    count = 0
+    if show:
+        # Plotting is interactive and matplotlib is not fork-safe,
+        # so convert serially in the main process
+        for file_path in sps_files:
+            if _convert_one(file_path, dest_dir, as_numpy, as_csv, quantize, show=True) is None:
+                continue
+            count += 1
+            print(f"\tConverted {count}/{len(sps_files)} sps files...")
+    else:
+        # Each file is an independent mmap->parse->write pipeline, so
+        # fan out across all cores (parsing is CPU-bound, hence processes)
+        worker = partial(_convert_one, dest_dir=dest_dir, as_numpy=as_numpy, as_csv=as_csv, quantize=quantize)
+        with ProcessPoolExecutor(max_workers=os.cpu_count()) as executor:
+            for result in executor.map(worker, sps_files, chunksize=4):
+                if result is None:
+                    continue
+                count += 1
+                print(f"\tConverted {count}/{len(sps_files)} sps files...")
+
     print(f"Complete!")
 
 if __name__ =='__main__':